@@ -2,7 +2,8 @@ import os
 import traceback
 
 import pymupdf as pdf
-from PySide6.QtGui import QImage
+from page_renderer import MUPDF_LOCK, PdfRenderThread
+from PySide6.QtGui import QCloseEvent, QImage
 from PySide6.QtWidgets import QFileDialog, QHBoxLayout, QMainWindow, QWidget
 from viewer.image_pages_viewer import ClipSelectViewer, SelectedRect
 from viewer.segment_viewer import Segment, SegmentViewer
@@ -16,6 +17,8 @@ class MainWindow(QMainWindow):
         self.setWindowTitle('pdf-clip')
 
         self.file_path: str | None = None
+        self.render_thread: PdfRenderThread | None = None
+        self.document: pdf.Document | None = None  # 保持打开，用于按缩放重新渲染页面
 
     def setup_menu(self) -> None:
         self.menu_files = self.menuBar().addMenu('文件')
@@ -67,44 +70,71 @@ class MainWindow(QMainWindow):
         if not file_path:
             return
 
+        # 在后台线程中将每一页转为图像，加载完成前不能再打开其它文件
+        self.action_open.setEnabled(False)
+        self.render_thread = PdfRenderThread(file_path, self)
+        self.render_thread.progress.connect(self.on_render_progress)
+        self.render_thread.rendered.connect(self.on_pages_rendered)
+        self.render_thread.failed.connect(self.on_render_failed)
+        self.render_thread.start()
+
+    def on_render_progress(self, finished_count: int, page_count: int) -> None:
+        self.statusBar().showMessage(f'正在加载页面 {finished_count}/{page_count}')
+
+    def on_pages_rendered(self, images: list[QImage]) -> None:
+        """
+        页面渲染完成后显示图像
+        """
+        assert self.render_thread is not None
+
+        self.action_open.setEnabled(True)
+        file_path = self.render_thread.file_path
+        self.render_thread.deleteLater()
+        self.render_thread = None
+
         try:
-            doc = pdf.open(file_path)
+            with MUPDF_LOCK:
+                document = pdf.open(file_path)
+        except Exception as e:
+            print(f'打开文件出错: {e}')
+            return
 
-            # 将每一页转为图像
-            images = []
-            for page_num in range(len(doc)):
-                page = doc[page_num]
-                # 将页面转换为图像（DPI 150 获得足够清晰度）
-                pix = page.get_pixmap(matrix=pdf.Matrix(1.5, 1.5))
+        self.viewer_left.set_images(images, document)
+        self.viewer_right.clear()
 
-                # 将 pixmap 转换为 QImage
-                image_data = pix.tobytes("ppm")
-                q_image = QImage()
-                q_image.loadFromData(image_data)
-                images.append(q_image)
+        # set_images 返回后旧文档不再被使用，可以关闭
+        if self.document is not None:
+            with MUPDF_LOCK:
+                self.document.close()
+        self.document = document
 
-            doc.close()
+        self.file_path = file_path
+        self.statusBar().clearMessage()
 
-            self.viewer_left.set_images(images)
-            self.viewer_right.clear()
+    def on_render_failed(self, message: str) -> None:
+        assert self.render_thread is not None
 
-            self.file_path = file_path
+        self.action_open.setEnabled(True)
+        self.render_thread.deleteLater()
+        self.render_thread = None
+        print(f'打开文件出错: {message}')
+        self.statusBar().clearMessage()
 
-        except Exception as e:
-            print(f'打开文件出错: {e}')
+    def closeEvent(self, event: QCloseEvent) -> None:
+        # 正在加载时关闭窗口，需要等待后台线程结束，否则线程对象被销毁时进程会异常退出
+        if self.render_thread is not None:
+            self.render_thread.requestInterruption()
+            self.render_thread.wait()
+        super().closeEvent(event)
 
     def on_clip_selected(self, rect: SelectedRect) -> None:
         """
         处理矩形选择信号
         """
-        # 如果在 SegmentViewer 中没有足够的页面 (diff>0)，则创建
-        for i in range(self.viewer_right.pages_count(), rect.page_index + 1):
-            self.viewer_right.add_page(self.viewer_left.images[i].size())
-
         # 根据 rect 的范围截取图像
-        source_pixmap = self.viewer_left.images[rect.page_index]
-        source_width = source_pixmap.width()
-        source_height = source_pixmap.height()
+        source_image = self.viewer_left.images[rect.page_index]
+        source_width = source_image.width()
+        source_height = source_image.height()
 
         # 计算实际像素坐标
         x = int(rect.x_min * source_width)
@@ -112,11 +142,22 @@ class MainWindow(QMainWindow):
         width = int((rect.x_max - rect.x_min) * source_width)
         height = int((rect.y_max - rect.y_min) * source_height)
 
-        # 截取图像
-        clipped = source_pixmap.copy(x, y, width, height)
+        # 选择矩形恰好落在页面边缘时截取范围为空，忽略
+        if width <= 0 or height <= 0:
+            return
+
+        # 截取图像，截取后仍保持 RGB888 格式
+        clipped_image = source_image.copy(x, y, width, height)
+        if clipped_image.isNull():
+            return
+        assert clipped_image.format() == QImage.Format.Format_RGB888
+
+        # 如果在 SegmentViewer 中没有足够的页面 (diff>0)，则创建
+        for i in range(self.viewer_right.pages_count(), rect.page_index + 1):
+            self.viewer_right.add_page(self.viewer_left.images[i].size())
 
         # 传递 Segment
-        self.viewer_right.add_segment(Segment(rect, clipped))
+        self.viewer_right.add_segment(Segment.from_image(rect, clipped_image))
 
     def on_export_file(self) -> None:
         if not self.file_path:
@@ -144,35 +185,37 @@ class MainWindow(QMainWindow):
         segments_sorted = sorted(segments, key=lambda t: t.target_rect.page_index)
 
         try:
-            doc = pdf.open(self.file_path)
-            new_doc = pdf.open()
-
-            current_page_index = -1
-            current_page = None
-
-            for segment in segments_sorted:
-                page_index = segment.selected_rect.page_index
-                target_page_index = segment.target_rect.page_index
-
-                # 进入新页面时创建对应的新页
-                if target_page_index != current_page_index:
-                    source_page = doc[target_page_index]
-                    current_page = new_doc.new_page(
-                        width=source_page.rect.width,
-                        height=source_page.rect.height
+            # 后台线程可能正在使用 MuPDF 重新渲染页面
+            with MUPDF_LOCK:
+                doc = pdf.open(self.file_path)
+                new_doc = pdf.open()
+
+                current_page_index = -1
+                current_page = None
+
+                for segment in segments_sorted:
+                    page_index = segment.selected_rect.page_index
+                    target_page_index = segment.target_rect.page_index
+
+                    # 进入新页面时创建对应的新页
+                    if target_page_index != current_page_index:
+                        source_page = doc[target_page_index]
+                        current_page = new_doc.new_page(
+                            width=source_page.rect.width,
+                            height=source_page.rect.height
+                        )
+                        current_page_index = target_page_index
+
+                    current_page.show_pdf_page(
+                        self.get_pdf_rect(current_page, segment.target_rect),
+                        doc,
+                        page_index,
+                        clip=self.get_pdf_rect(current_page, segment.selected_rect)
                     )
-                    current_page_index = target_page_index
-
-                current_page.show_pdf_page(
-                    self.get_pdf_rect(current_page, segment.target_rect),
-                    doc,
-                    page_index,
-                    clip=self.get_pdf_rect(current_page, segment.selected_rect)
-                )
-
-            new_doc.save(file_path)
-            new_doc.close()
-            doc.close()
+
+                new_doc.save(file_path)
+                new_doc.close()
+                doc.close()
 
         except Exception as e:
             print(f'导出文件出错：{e}')
@@ -0,0 +1,75 @@
+import threading
+
+import pymupdf as pdf
+from PySide6.QtCore import QThread, Signal
+from PySide6.QtGui import QImage
+
+
+# PyMuPDF 不支持多线程：所有线程共用一个全局 MuPDF 上下文，
+# 任何线程调用 MuPDF 时都必须持有此锁
+MUPDF_LOCK = threading.Lock()
+
+# 将页面转换为图像时使用的变换（DPI 150 获得足够清晰度）
+RENDER_MATRIX = pdf.Matrix(1.5, 1.5)
+
+
+def pixmap_to_image(pix: pdf.Pixmap) -> QImage:
+    """
+    根据 MuPDF pixmap 的像素数据构造 QImage
+    PDF 页面没有透明度，直接使用 MuPDF 的 RGB888 格式，不进行任何格式转换；
+    通过 samples_mv 直接访问 pix 的缓冲区而不先复制为 bytes，
+    再由 copy() 复制一次，使 QImage 拥有独立的数据，不依赖于 pix 的生命周期
+    """
+    assert not pix.alpha, 'pages must be rendered with alpha=False'
+    return QImage(pix.samples_mv, pix.width, pix.height, pix.stride, QImage.Format.Format_RGB888).copy()
+
+
+class PdfRenderThread(QThread):
+    """
+    在后台线程中逐页渲染 PDF 的所有页面，避免阻塞界面
+    """
+
+    progress = Signal(int, int)  # (已完成页数, 总页数)
+    rendered = Signal(list)  # list[QImage]，按页码顺序
+    failed = Signal(str)
+
+    def __init__(self, file_path: str, parent=None):
+        super().__init__(parent)
+        self.file_path = file_path
+
+    def run(self) -> None:
+        try:
+            images = self.render_pages()
+        except Exception as e:
+            self.failed.emit(str(e))
+            return
+
+        if images is not None:
+            self.rendered.emit(images)
+
+    def render_pages(self) -> list[QImage] | None:
+        """
+        按顺序渲染所有页面，如果在渲染过程中被请求中断则返回 None
+        每次调用 MuPDF 时都持有 MUPDF_LOCK，渲染页面之间释放，使其它线程也能使用 MuPDF
+        """
+        with MUPDF_LOCK:
+            doc = pdf.open(self.file_path)
+
+        try:
+            page_count = len(doc)
+            images = []
+            for page_num in range(page_count):
+                # 关闭窗口时会请求中断，不再渲染剩余的页面
+                if self.isInterruptionRequested():
+                    return None
+                with MUPDF_LOCK:
+                    pix = doc[page_num].get_pixmap(matrix=RENDER_MATRIX, alpha=False)
+                    # QImage 可以在非界面线程中构造；释放 pix 也会调用 MuPDF，必须在持有锁时进行
+                    images.append(pixmap_to_image(pix))
+                    del pix
+                self.progress.emit(page_num + 1, page_count)
+            return images
+
+        finally:
+            with MUPDF_LOCK:
+                doc.close()
@@ -1,79 +1,162 @@
+import bisect
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import List
+from typing import Iterable, List
 
-from PySide6.QtCore import QPoint, QRect, Qt, Signal
+import pymupdf as pdf
+from page_renderer import MUPDF_LOCK, pixmap_to_image
+from PySide6.QtCore import (QPoint, QRect, QRunnable, Qt, QThreadPool,
+                            Signal)
 from PySide6.QtGui import QColor, QImage, QMouseEvent, QPainter, QPixmap
 from PySide6.QtWidgets import QWidget
-from viewer.scroll_viewer import ScrollViewer
+from viewer.scroll_viewer import PAGE_SPACING, ScrollViewer
+
+
+class ScaleTask(QRunnable):
+    """
+    在线程池中对页面图像进行高质量缩放的任务
+    """
+    def __init__(self, viewer: 'ImagePagesViewer', generation: int,
+                 page_index: int, zoom_bucket: float):
+        super().__init__()
+        self.viewer = viewer
+        self.generation = generation
+        self.page_index = page_index
+        self.zoom_bucket = zoom_bucket
+
+    def run(self) -> None:
+        if self.viewer.document is not None:
+            # 有原始文档时直接由 MuPDF 按目标尺寸重新渲染
+            scaled_image = self.viewer.rerender_at_zoom(self.page_index, self.zoom_bucket)
+        else:
+            image = self.viewer.images[self.page_index]
+            scaled_image = image.scaled(
+                int(image.width() * self.zoom_bucket),
+                int(image.height() * self.zoom_bucket),
+                Qt.AspectRatioMode.KeepAspectRatio,
+                Qt.TransformationMode.SmoothTransformation
+            )
+        # 跨线程发出信号，由界面线程接收结果
+        self.viewer.page_scaled.emit(self.generation, self.page_index, self.zoom_bucket, scaled_image)
 
 
 class ImagePagesViewer(ScrollViewer):
     """
     图像页面查看器
+
+    每个页面预先生成一张低分辨率的概览图，在高质量缩放图像准备好之前用于绘制；
+    高质量缩放在后台线程池中进行，并在滚轮缩放停止后才开始。
+    如果提供了原始 PDF 文档，高质量图像由 MuPDF 按目标尺寸重新渲染（持有 MUPDF_LOCK），否则缩放原图像
     """
+    SCALED_CACHE_SIZE = 32  # 缩放后图像缓存的最大数量
+    OVERVIEW_WIDTH = 256  # 概览图的宽度
+
+    page_scaled = Signal(int, int, float, QImage)  # (generation, page_index, zoom_bucket, scaled_image)
+
     def __init__(self, parent: QWidget | None = None):
         super().__init__(parent)
-        self.images: List[QPixmap] = []
-        self.scaled_pixmaps: List[QPixmap] = []  # 缩放后的图像缓存
-
-    def set_images(self, images: List[QImage]) -> None:
+        self.images: List[QImage] = []
+        self.document: pdf.Document | None = None
+        self.overview_pixmaps: List[QPixmap] = []
+        # 缩放后的图像缓存（LRU），键为 (页面索引, 缩放因子)
+        self.scaled_pixmaps: OrderedDict[tuple[int, float], QPixmap] = OrderedDict()
+        self.pending_scales: set[tuple[int, float]] = set()  # 正在后台缩放的键
+        # 每次 set_images 时递增，用于丢弃旧文档的缩放结果
+        self.images_generation = 0
+
+        self.scale_pool = QThreadPool(self)
+        self.page_scaled.connect(self.on_page_scaled)
+
+    def set_images(self, images: List[QImage], document: pdf.Document | None = None) -> None:
         """
-        设置要显示的图像列表
+        设置要显示的图像列表，以及（可选的）用于重新渲染这些页面的 PDF 文档
         """
-        self.images = [QPixmap.fromImage(img) for img in images]
-        self.scroll_offset = -self.PAGE_SPACING
+        # 等待正在进行的后台缩放结束，之后旧的图像和文档不再被访问
+        self.scale_pool.clear()
+        self.scale_pool.waitForDone()
+        self.images_generation += 1
+        self.pending_scales.clear()
+        self.scaled_pixmaps.clear()
+
+        self.images = images
+        self.document = document
+        self.invalidate_page_tops()
+        # 缩放得到的图像只是临时对象，使用 fromImageInPlace 直接复用其数据，避免再复制一次
+        self.overview_pixmaps = [
+            QPixmap.fromImageInPlace(
+                img.scaledToWidth(self.OVERVIEW_WIDTH, Qt.TransformationMode.FastTransformation)
+            )
+            for img in images
+        ]
+        self.scroll_offset = -PAGE_SPACING
 
-        # 自动计算缩放因子以适应当前宽度（左右各留 PAGE_SPACING）
+        # 自动计算缩放因子以适应当前宽度
         if self.images and self.width() > 0:
-            first_image = self.images[0]
-            available_width = self.width() - 2 * self.PAGE_SPACING
-            self.zoom_factor = available_width / first_image.width()
-            # 限制缩放范围
-            self.zoom_factor = max(
-                self.min_zoom,
-                min(self.max_zoom, self.zoom_factor)
-            )
+            self.fit_zoom_to(self.images[0].width())
         else:
             self.zoom_factor = 1.0
 
-        self.update_scaled_pixmaps()
         self.update()
 
-    def update_scaled_pixmaps(self) -> None:
+    def get_scaled_pixmap(self, page_index: int, schedule: bool = True) -> QPixmap | None:
         """
-        根据缩放因子更新所有缩放后的图像缓存
+        获取指定页面在当前缩放因子下的高质量图像
+        如果缓存中不存在则返回 None，schedule 为 True 时安排后台缩放
         """
-        self.scaled_pixmaps = []
-        for pixmap in self.images:
-            scaled_width = int(pixmap.width() * self.zoom_factor)
-            scaled_height = int(pixmap.height() * self.zoom_factor)
-            scaled_pixmap = pixmap.scaled(
-                scaled_width,
-                scaled_height,
-                Qt.AspectRatioMode.KeepAspectRatio,
-                Qt.TransformationMode.SmoothTransformation
-            )
-            self.scaled_pixmaps.append(scaled_pixmap)
+        key = (page_index, round(self.zoom_factor, 3))
+        pixmap = self.scaled_pixmaps.get(key)
+        if pixmap is not None:
+            self.scaled_pixmaps.move_to_end(key)
+            return pixmap
 
-    def on_zoom_changed(self) -> None:
+        if schedule and key not in self.pending_scales:
+            self.pending_scales.add(key)
+            self.scale_pool.start(ScaleTask(self, self.images_generation, page_index, key[1]))
+
+        return None
+
+    def rerender_at_zoom(self, page_index: int, zoom: float) -> QImage:
         """
-        缩放因子改变时更新缩放后的图像缓存
+        使用 MuPDF 按缩放后的尺寸重新渲染页面，比缩放已渲染的图像更清晰，大页面时也更快
         """
-        self.update_scaled_pixmaps()
+        assert self.document is not None
+
+        target_width = self.images[page_index].width() * zoom
+        with MUPDF_LOCK:
+            page = self.document[page_index]
+            scale = target_width / page.rect.width
+            pix = page.get_pixmap(matrix=pdf.Matrix(scale, scale), alpha=False)
+            image = pixmap_to_image(pix)
+            # 释放 page 和 pix 也会调用 MuPDF，必须在持有锁时进行
+            del page, pix
 
-    def get_content_height(self) -> int:
+        return image
+
+    def on_page_scaled(self, generation: int, page_index: int, zoom_bucket: float,
+                       scaled_image: QImage) -> None:
         """
-        获取内容的总高度（实现 ScrollViewer 的抽象方法）
+        后台缩放完成后将结果放入缓存
         """
-        if not self.images:
-            return 0
+        if generation != self.images_generation:
+            return
 
-        total_height = 0
-        for pixmap in self.images:
-            scaled_height = int(pixmap.height() * self.zoom_factor)
-            total_height += scaled_height + self.PAGE_SPACING
+        key = (page_index, zoom_bucket)
+        self.pending_scales.discard(key)
 
-        return total_height
+        # scaled_image 之后不再使用，直接复用其数据
+        self.scaled_pixmaps[key] = QPixmap.fromImageInPlace(scaled_image)
+        if len(self.scaled_pixmaps) > self.SCALED_CACHE_SIZE:
+            self.scaled_pixmaps.popitem(last=False)
+
+        # 只有当前缩放因子下的结果需要重绘
+        if zoom_bucket == round(self.zoom_factor, 3):
+            self.update()
+
+    def get_page_heights(self) -> Iterable[int]:
+        """
+        获取所有页面未缩放时的高度（实现 ScrollViewer 的抽象方法）
+        """
+        return (image.height() for image in self.images)
 
     def paintEvent(self, event) -> None:
         """
@@ -82,30 +165,51 @@ class ImagePagesViewer(ScrollViewer):
         if not self.images:
             return
 
+        zooming = self.is_zooming()
+
         p = QPainter(self)
-        p.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform)
+        # 缩放过程中使用快速拉伸
+        p.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform, not zooming)
+
+        page_tops = self.get_page_tops()
+        dirty_rect = event.rect()  # 需要重绘的区域
 
-        y_offset = -self.scroll_offset  # 当前绘制的 y 坐标
-        widget_height = self.height()
+        # 二分查找第一个可能与重绘区域相交的页面（边框比页面多占 1 像素）
+        first_page = max(0, bisect.bisect_right(page_tops, dirty_rect.top() - 1 + self.scroll_offset) - 1)
 
         p.setPen(QColor(200, 200, 200))
-        for scaled_pixmap in self.scaled_pixmaps:
-            scaled_width, scaled_height = scaled_pixmap.size().toTuple()
+        for page_index in range(first_page, len(self.images)):
+            y_offset = page_tops[page_index] - self.scroll_offset  # 当前绘制的 y 坐标
+            if y_offset > dirty_rect.bottom():
+                break
+
+            image = self.images[page_index]
+            scaled_width = int(image.width() * self.zoom_factor)
+            scaled_height = int(image.height() * self.zoom_factor)
 
             # 计算绘制位置（水平居中）
-            x = (self.width() - scaled_pixmap.width()) // 2
+            x = (self.width() - scaled_width) // 2
 
-            # 只绘制在可见范围内的图像
-            if y_offset + scaled_height > 0 and y_offset < widget_height:
-                p.drawPixmap(x, y_offset, scaled_pixmap)
+            # 跳过与重绘区域不相交的页面
+            page_rect = QRect(x, y_offset, scaled_width, scaled_height)
+            if not dirty_rect.intersects(page_rect.adjusted(0, 0, 1, 1)):
+                continue
 
-            # 绘制页面边框
-            p.drawRect(x, int(y_offset), scaled_width, scaled_height)
+            # 依次使用：当前缩放因子下的高质量图像、缩放前的高质量图像、概览图
+            # 缩放过程中不安排新的缩放，停止缩放后再生成当前缩放因子下的图像
+            pixmap = self.get_scaled_pixmap(page_index, schedule=not zooming)
+            if pixmap is None:
+                pixmap = self.scaled_pixmaps.get((page_index, round(self.settled_zoom, 3)))
+            if pixmap is None:
+                pixmap = self.overview_pixmaps[page_index]
+            # MuPDF 渲染的尺寸可能与布局相差一两个像素，后两者也需要拉伸，始终填满页面区域
+            p.drawPixmap(page_rect, pixmap)
 
-            y_offset += scaled_height + self.PAGE_SPACING
+            # 绘制页面边框
+            p.drawRect(page_rect)
 
 
-@dataclass
+@dataclass(slots=True)
 class SelectedRect:
     page_index: int
     # 以下这四个值都是 0~1 的数，表示占页面尺寸的比例
@@ -128,31 +232,33 @@ class ClipSelectViewer(ImagePagesViewer):
         self.selecting = False
         self.select_start_pos = None
         self.select_end_pos = None
+        # 开始选择时截取的控件画面，选择过程中只需在其上绘制选择矩形
+        self.selection_background: QPixmap | None = None
 
-    def get_page_positions(self) -> list[tuple[int, int, float]]:
+    def get_page_position(self, page_index: int) -> tuple[int, int, int]:
         """
-        获取所有页面在显示中的位置信息
-        返回列表，每项为 (y_start, y_end, scaled_width, scaled_height)
+        获取页面在显示中的位置信息
+        返回 (y_start, y_end, scaled_width)
         """
-        positions = []
-        y_offset = -self.scroll_offset
-
-        for pixmap in self.images:
-            scaled_width = pixmap.width() * self.zoom_factor
-            scaled_height = pixmap.height() * self.zoom_factor
-
-            y_start = y_offset
-            y_end = y_offset + scaled_height
+        page_tops = self.get_page_tops()
+        y_start = page_tops[page_index] - self.scroll_offset
+        y_end = page_tops[page_index + 1] - PAGE_SPACING - self.scroll_offset
+        return y_start, y_end, int(self.images[page_index].width() * self.zoom_factor)
 
-            positions.append((y_start, y_end, scaled_width))
-            y_offset += scaled_height + self.PAGE_SPACING
-
-        return positions
+    def get_page_range(self, y_top: int, y_bottom: int) -> range:
+        """
+        二分查找纵向范围 [y_top, y_bottom]（控件坐标）可能涉及的页面索引区间
+        """
+        page_tops = self.get_page_tops()
+        first_page = max(0, bisect.bisect_right(page_tops, y_top + self.scroll_offset) - 1)
+        last_page = min(len(self.images), bisect.bisect_right(page_tops, y_bottom + self.scroll_offset))
+        return range(first_page, last_page)
 
     def mousePressEvent(self, event: QMouseEvent) -> None:
         if event.modifiers() == Qt.KeyboardModifier.ControlModifier and \
                 event.button() == Qt.MouseButton.LeftButton:
             # Ctrl+左键开始选择
+            self.selection_background = self.grab()
             self.selecting = True
             self.select_start_pos = event.pos()
             self.select_end_pos = event.pos()
@@ -162,8 +268,10 @@ class ClipSelectViewer(ImagePagesViewer):
 
     def mouseMoveEvent(self, event: QMouseEvent) -> None:
         if self.selecting:
+            old_rect = self.get_selection_rect()
             self.select_end_pos = event.pos()
-            self.update()
+            # 只重绘选择矩形变化的区域（边框比矩形多占 1 像素）
+            self.update(old_rect.united(self.get_selection_rect()).adjusted(0, 0, 1, 1))
         else:
             super().mouseMoveEvent(event)
 
@@ -174,6 +282,7 @@ class ClipSelectViewer(ImagePagesViewer):
             assert self.select_end_pos is not None
 
             self.selecting = False
+            self.selection_background = None
 
             # 过滤移动距离过短的（所有方向上的移动量小于4）
             delta = self.select_end_pos - self.select_start_pos
@@ -197,11 +306,11 @@ class ClipSelectViewer(ImagePagesViewer):
         rect_top = min(y1, y2)
         rect_bottom = max(y1, y2)
 
-        # 获取矩形涉及的所有页面
-        positions = self.get_page_positions()
+        # 只遍历矩形纵向范围内的页面
+        for page_index in self.get_page_range(rect_top, rect_bottom):
+            y_start, y_end, scaled_width = self.get_page_position(page_index)
 
-        for page_index, (y_start, y_end, scaled_width) in enumerate(positions):
-            # 检查矩形是否与此页面相交
+            # 检查矩形是否与此页面相交（矩形顶部可能位于页面间隔中）
             if rect_bottom < y_start or rect_top > y_end:
                 continue
 
@@ -225,11 +334,49 @@ class ClipSelectViewer(ImagePagesViewer):
 
             self.clip_selected.emit(SelectedRect(page_index, x_min, x_max, y_min, y_max))
 
+    def on_scroll_changed(self) -> None:
+        # 画面内容改变，截取的画面不再可用
+        self.selection_background = None
+        super().on_scroll_changed()
+
+    def on_page_scaled(self, generation: int, page_index: int, zoom_bucket: float,
+                       scaled_image: QImage) -> None:
+        # 画面内容可能改变，截取的画面不再可用
+        self.selection_background = None
+        super().on_page_scaled(generation, page_index, zoom_bucket, scaled_image)
+
+    def get_selection_rect(self) -> QRect:
+        """
+        获取当前选择矩形
+        """
+        assert self.select_start_pos is not None
+        assert self.select_end_pos is not None
+
+        x1 = self.select_start_pos.x()
+        y1 = self.select_start_pos.y()
+        x2 = self.select_end_pos.x()
+        y2 = self.select_end_pos.y()
+
+        return QRect(min(x1, x2), min(y1, y2), abs(x2 - x1),
+                     abs(y2 - y1))
+
     def paintEvent(self, event) -> None:
         """
         绘制所有图像和选择矩形
         """
-        super().paintEvent(event)
+        if self.selecting and self.selection_background is not None:
+            # 选择过程中直接使用截取的画面，不重新绘制所有页面
+            painter = QPainter(self)
+            dirty_rect = event.rect()
+            dpr = self.selection_background.devicePixelRatio()
+            painter.drawPixmap(
+                dirty_rect,
+                self.selection_background,
+                QRect(dirty_rect.topLeft() * dpr, dirty_rect.size() * dpr)
+            )
+            painter.end()
+        else:
+            super().paintEvent(event)
 
         # 绘制选择矩形
         if self.selecting and self.select_start_pos is not None and \
@@ -237,13 +384,7 @@ class ClipSelectViewer(ImagePagesViewer):
 
             painter = QPainter(self)
 
-            x1 = self.select_start_pos.x()
-            y1 = self.select_start_pos.y()
-            x2 = self.select_end_pos.x()
-            y2 = self.select_end_pos.y()
-
-            rect = QRect(min(x1, x2), min(y1, y2), abs(x2 - x1),
-                         abs(y2 - y1))
+            rect = self.get_selection_rect()
 
             # 绘制矩形边框
             painter.drawRect(rect)
@@ -1,31 +1,89 @@
-from PySide6.QtCore import Qt
+from itertools import accumulate
+from typing import Iterable
+
+from PySide6.QtCore import Qt, QTimer
 from PySide6.QtGui import QMouseEvent, QWheelEvent
 from PySide6.QtWidgets import QWidget
 
+PAGE_SPACING = 10  # 页面之间以及页面与控件边缘的间距
+MIN_ZOOM = 0.1
+MAX_ZOOM = 5.0
+
 
 class ScrollViewer(QWidget):
     """
     可滚动视图基类，支持缩放功能
     """
-    PAGE_SPACING = 10
+    ZOOM_DELAY = 50  # 滚轮缩放停止多久后才调用 on_zoom_changed（毫秒）
 
     def __init__(self, parent: QWidget | None = None):
         super().__init__(parent)
-        self.scroll_offset = -self.PAGE_SPACING  # 纵向滚动偏移
+        self.scroll_offset = -PAGE_SPACING  # 纵向滚动偏移
         self.zoom_factor = 1.0
-        self.min_zoom = 0.1
-        self.max_zoom = 5.0
+        # 缓存各页面顶部在内容中的 y 坐标（前缀和），最后一项为内容总高度
+        self.page_tops: list[int] = [0]
+        self.page_tops_zoom: float | None = None  # 计算 page_tops 时的缩放因子，None 表示需要重新计算
+        # 本次缩放手势开始前的缩放因子，缩放过程中可以将该缩放因子下的缓存快速拉伸后绘制
+        self.settled_zoom = self.zoom_factor
+        self.zoom_timer = QTimer(self)
+        self.zoom_timer.setSingleShot(True)
+        self.zoom_timer.setInterval(self.ZOOM_DELAY)
+        self.zoom_timer.timeout.connect(self.on_zoom_finished)
         self.setFocusPolicy(Qt.FocusPolicy.StrongFocus)
 
-    def get_content_height(self) -> int:
+    def fit_zoom_to(self, width: int) -> None:
+        """
+        设置缩放因子，使宽度为 width 的页面适应当前控件宽度（左右各留 PAGE_SPACING）
+        """
+        available_width = self.width() - 2 * PAGE_SPACING
+        self.zoom_factor = max(MIN_ZOOM, min(MAX_ZOOM, available_width / width))
+
+    def get_page_heights(self) -> Iterable[int]:
         """
-        获取内容的总高度（需要子类实现）
+        获取所有页面未缩放时的高度（需要子类实现）
         """
         raise NotImplementedError()
 
+    def invalidate_page_tops(self) -> None:
+        """
+        页面增减时调用，使 page_tops 在下次使用时重新计算
+        """
+        self.page_tops_zoom = None
+
+    def get_page_tops(self) -> list[int]:
+        """
+        获取各页面顶部在内容中的 y 坐标，最后一项为内容总高度
+        只在页面或缩放因子改变后重新计算
+        """
+        if self.page_tops_zoom != self.zoom_factor:
+            self.page_tops = list(accumulate(
+                (int(height * self.zoom_factor) + PAGE_SPACING for height in self.get_page_heights()),
+                initial=0
+            ))
+            self.page_tops_zoom = self.zoom_factor
+
+        return self.page_tops
+
+    def get_content_height(self) -> int:
+        """
+        获取内容的总高度
+        """
+        return self.get_page_tops()[-1]
+
+    def is_zooming(self) -> bool:
+        """
+        是否正处于滚轮缩放过程中
+        """
+        return self.zoom_timer.isActive()
+
+    def on_zoom_finished(self) -> None:
+        self.on_zoom_changed()
+        self.update()
+
     def on_zoom_changed(self) -> None:
         """
         缩放因子改变时的回调（子类可以重写以更新内容）
+        连续滚轮缩放时只在停止后调用一次
         """
         pass
 
@@ -43,6 +101,8 @@ class ScrollViewer(QWidget):
 
             # 记录缩放前的参数
             old_zoom = self.zoom_factor
+            if not self.is_zooming():
+                self.settled_zoom = old_zoom
             old_scroll_offset = self.scroll_offset
 
             # 计算缩放中心（视口中心）
@@ -58,10 +118,7 @@ class ScrollViewer(QWidget):
                 self.zoom_factor /= zoom_step
 
             # 限制缩放范围
-            self.zoom_factor = max(
-                self.min_zoom,
-                min(self.max_zoom, self.zoom_factor)
-            )
+            self.zoom_factor = max(MIN_ZOOM, min(MAX_ZOOM, self.zoom_factor))
 
             # 缩放后，同一个内容位置的新坐标
             # 高度缩放比例
@@ -73,8 +130,9 @@ class ScrollViewer(QWidget):
 
             # 重新限制滚动偏移
             self.clamp_scroll_offset()
-            # 通知子类缩放已改变
-            self.on_zoom_changed()
+            self.on_scroll_changed()
+            # 缩放停止后再通知子类缩放已改变，避免为中间的缩放因子重建缓存
+            self.zoom_timer.start()
             self.update()
         else:
             # 普通滚轮滚动
@@ -1,18 +1,24 @@
-import copy
+import bisect
+from array import array
+from collections import OrderedDict
 from dataclasses import dataclass, field
+from typing import Iterable
 
-from PySide6.QtCore import QPoint, QSize, Qt
-from PySide6.QtGui import QColor, QMouseEvent, QPainter, QPixmap
+from PySide6.QtCore import QBuffer, QIODevice, QPoint, QRect, QSize, Qt
+from PySide6.QtGui import QColor, QImage, QMouseEvent, QPainter, QPixmap
 from PySide6.QtWidgets import QWidget
-from viewer.image_pages_viewer import ScrollViewer, SelectedRect
+from viewer.image_pages_viewer import SelectedRect
+from viewer.scroll_viewer import PAGE_SPACING, ScrollViewer
 
 type PageGeometry = QSize
 
 
-@dataclass
+@dataclass(slots=True)
 class Segment:
     selected_rect: SelectedRect
-    clipped_pixmap: QPixmap
+    # 截取的图像以 JPEG 压缩保存，需要时再解码
+    clipped_bytes: bytes
+    clipped_size: QSize
 
     target_rect: SelectedRect = field(init=False)
 
@@ -21,33 +27,84 @@ class Segment:
     y_offset: float = 0
 
     def __post_init__(self):
-        self.target_rect = copy.copy(self.selected_rect)
+        rect = self.selected_rect
+        self.target_rect = SelectedRect(rect.page_index, rect.x_min, rect.x_max, rect.y_min, rect.y_max)
+
+    @classmethod
+    def from_image(cls, selected_rect: SelectedRect, image: QImage) -> 'Segment':
+        buffer = QBuffer()
+        buffer.open(QIODevice.OpenModeFlag.WriteOnly)
+        image.save(buffer, 'JPG', 85)
+        return cls(selected_rect, bytes(buffer.data()), image.size())
+
+    def decode_pixmap(self) -> QPixmap:
+        pixmap = QPixmap()
+        pixmap.loadFromData(self.clipped_bytes, 'JPG')
+        return pixmap
+
+
+class PixmapCache:
+    """
+    QPixmap 的 LRU 缓存，以像素数据的总字节数限制缓存大小
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.pixmaps: OrderedDict[int, QPixmap] = OrderedDict()
+
+    def get(self, key: int) -> QPixmap | None:
+        pixmap = self.pixmaps.get(key)
+        if pixmap is not None:
+            self.pixmaps.move_to_end(key)
+        return pixmap
+
+    def put(self, key: int, pixmap: QPixmap) -> None:
+        self.pixmaps[key] = pixmap
+        self.total_bytes += self.pixmap_bytes(pixmap)
+
+        # 超出上限时淘汰最久未使用的（至少保留刚放入的）
+        while self.total_bytes > self.max_bytes and len(self.pixmaps) > 1:
+            _, evicted = self.pixmaps.popitem(last=False)
+            self.total_bytes -= self.pixmap_bytes(evicted)
+
+    def clear(self) -> None:
+        self.pixmaps.clear()
+        self.total_bytes = 0
+
+    @staticmethod
+    def pixmap_bytes(pixmap: QPixmap) -> int:
+        return pixmap.width() * pixmap.height() * pixmap.depth() // 8
 
 
 class SegmentViewer(ScrollViewer):
+    SCALED_CACHE_SIZE = 256  # 缩放后图像缓存的最大数量
+    DECODED_CACHE_BYTES = 64 * 1024 * 1024  # 解码后的 segment 图像缓存的最大字节数
+
     def __init__(self, parent: QWidget | None = None):
         super().__init__(parent)
         self.pages: list[PageGeometry] = []
         self.segments: list[Segment] = []
-        self.scaled_segments: list[QPixmap] = []  # 缓存缩放后的图像
-        self.page_rects: list[tuple[int, int, int, int, int]] = []  # 缓存页面位置信息
+        # 每个页面上的 segment 索引（按添加顺序），用于快速查找鼠标下的 segment
+        self.segments_by_page: dict[int, list[int]] = {}
+        # 缩放后的图像缓存（LRU），键为 (id(segment), 缩放因子)，只在绘制到可见范围时才生成
+        self.scaled_segments: OrderedDict[tuple[int, float], QPixmap] = OrderedDict()
+        # 解码后的 segment 原图像缓存（LRU），键为 id(segment)
+        self.clipped_pixmaps = PixmapCache(self.DECODED_CACHE_BYTES)
+        # 缓存页面位置信息，按页面索引直接访问；只在使用前通过 ensure_page_rects 按需更新
+        self.page_x = array('i')
+        self.page_y = array('i')
+        self.page_w = array('i')
+        self.page_h = array('i')
+        self.page_rects_dirty = True
         self.hovered_segment_index: int | None = None  # 当前鼠标悬浮的 segment 索引
         self.dragging_segment: bool = False
         self.setMouseTracking(True)  # 使得 mouseMoveEvent 能在没有按下的时候也能响应
 
-    def get_content_height(self) -> int:
+    def get_page_heights(self) -> Iterable[int]:
         """
-        计算所有页面的总高度
+        获取所有页面未缩放时的高度
         """
-        if not self.pages:
-            return 0
-
-        total_height = 0
-        for page_rect in self.pages:
-            scaled_height = int(page_rect.height() * self.zoom_factor)
-            total_height += scaled_height + self.PAGE_SPACING
-
-        return total_height
+        return (page_rect.height() for page_rect in self.pages)
 
     def pages_count(self) -> int:
         return len(self.pages)
@@ -55,67 +112,115 @@ class SegmentViewer(ScrollViewer):
     def add_page(self, rect: PageGeometry) -> None:
         is_first_page = len(self.pages) == 0
         self.pages.append(rect)
+        self.invalidate_page_tops()
 
         # 如果是第一个页面，自动计算缩放因子以适应当前宽度
         if is_first_page and self.width() > 0:
-            available_width = self.width() - 2 * self.PAGE_SPACING
-            self.zoom_factor = available_width / rect.width()
-            # 限制缩放范围
-            self.zoom_factor = max(
-                self.min_zoom,
-                min(self.max_zoom, self.zoom_factor)
-            )
+            self.fit_zoom_to(rect.width())
             # 初始化偏移
-            self.scroll_offset = -self.PAGE_SPACING
+            self.scroll_offset = -PAGE_SPACING
 
-        self.update_page_rects()
+        self.page_rects_dirty = True
         self.update()
 
     def add_segment(self, segment: Segment) -> None:
+        self.segments_by_page.setdefault(segment.target_rect.page_index, []).append(len(self.segments))
         self.segments.append(segment)
-        self.update_scaled_segments()
         self.update()
 
     def clear(self) -> None:
         self.pages.clear()
+        self.invalidate_page_tops()
         self.segments.clear()
-        self.update_page_rects()
-        self.update_scaled_segments()
+        self.segments_by_page.clear()
+        self.scaled_segments.clear()
+        self.clipped_pixmaps.clear()
+        self.page_rects_dirty = True
         self.update()
 
-    def on_zoom_changed(self) -> None:
-        """缩放改变时更新缓存的缩放图像和页面位置"""
-        self.update_scaled_segments()
-        self.update_page_rects()
-
     def on_scroll_changed(self) -> None:
-        """滚动改变时更新页面位置"""
-        self.update_page_rects()
-
-    def update_scaled_segments(self) -> None:
-        """更新所有 segments 的缩放图像缓存"""
-        self.scaled_segments = []
-        for segment in self.segments:
-            img_width = int(segment.clipped_pixmap.width() * self.zoom_factor)
-            img_height = int(segment.clipped_pixmap.height() * self.zoom_factor)
-            scaled = segment.clipped_pixmap.scaled(
-                img_width, img_height,
-                aspectMode=Qt.AspectRatioMode.KeepAspectRatio,
-                mode=Qt.TransformationMode.SmoothTransformation
-            )
-            self.scaled_segments.append(scaled)
+        """滚动改变时标记页面位置需要更新，在下次使用时再计算"""
+        self.page_rects_dirty = True
+
+    def resizeEvent(self, event) -> None:
+        # 页面水平居中，宽度改变时位置也会改变
+        self.page_rects_dirty = True
+        super().resizeEvent(event)
+
+    def get_scaled_segment_size(self, index: int) -> QSize:
+        """获取 segment 缩放后的尺寸，不需要生成缩放图像"""
+        key = (id(self.segments[index]), round(self.zoom_factor, 3))
+        pixmap = self.scaled_segments.get(key)
+        if pixmap is not None:
+            return pixmap.size()
+
+        clipped_size = self.segments[index].clipped_size
+        return QSize(
+            int(clipped_size.width() * self.zoom_factor),
+            int(clipped_size.height() * self.zoom_factor)
+        )
+
+    def get_clipped_pixmap(self, segment: Segment) -> QPixmap:
+        """获取 segment 解码后的原图像，只在缓存中不存在时才解码"""
+        pixmap = self.clipped_pixmaps.get(id(segment))
+        if pixmap is None:
+            pixmap = segment.decode_pixmap()
+            self.clipped_pixmaps.put(id(segment), pixmap)
+        return pixmap
+
+    def get_scaled_segment(self, index: int, scale: bool = True) -> QPixmap | None:
+        """
+        获取 segment 的缩放图像，只在缓存中不存在时才进行缩放
+        scale 为 False 时不进行缩放，缓存中不存在则返回 None
+        """
+        key = (id(self.segments[index]), round(self.zoom_factor, 3))
+        pixmap = self.scaled_segments.get(key)
+        if pixmap is not None:
+            self.scaled_segments.move_to_end(key)
+            return pixmap
+
+        if not scale:
+            return None
+
+        pixmap = self.get_clipped_pixmap(self.segments[index]).scaled(
+            self.get_scaled_segment_size(index),
+            aspectMode=Qt.AspectRatioMode.KeepAspectRatio,
+            mode=Qt.TransformationMode.SmoothTransformation
+        )
+
+        self.scaled_segments[key] = pixmap
+        if len(self.scaled_segments) > self.SCALED_CACHE_SIZE:
+            self.scaled_segments.popitem(last=False)
+
+        return pixmap
+
+    def ensure_page_rects(self) -> None:
+        """如果页面位置信息已过期，则重新计算"""
+        if self.page_rects_dirty:
+            self.update_page_rects()
+            self.page_rects_dirty = False
 
     def update_page_rects(self) -> None:
         """更新所有页面位置信息缓存"""
-        self.page_rects = []
-        y_offset = -self.scroll_offset
+        self.page_x = array('i')
+        self.page_y = array('i')
+        self.page_w = array('i')
+        self.page_h = array('i')
+        page_tops = self.get_page_tops()
 
         for page_index, page_rect in enumerate(self.pages):
             scaled_width = int(page_rect.width() * self.zoom_factor)
-            scaled_height = int(page_rect.height() * self.zoom_factor)
-            x = (self.width() - scaled_width) // 2
-            self.page_rects.append((page_index, x, int(y_offset), scaled_width, scaled_height))
-            y_offset += scaled_height + self.PAGE_SPACING
+            self.page_x.append((self.width() - scaled_width) // 2)
+            self.page_y.append(page_tops[page_index] - self.scroll_offset)
+            self.page_w.append(scaled_width)
+            self.page_h.append(page_tops[page_index + 1] - page_tops[page_index] - PAGE_SPACING)
+
+    def get_segment_position(self, segment: Segment) -> tuple[int, int]:
+        """计算 segment 的图像在控件中的位置"""
+        page_index = segment.target_rect.page_index
+        img_x = self.page_x[page_index] + int(segment.target_rect.x_min * self.page_w[page_index])
+        img_y = self.page_y[page_index] + int(segment.target_rect.y_min * self.page_h[page_index])
+        return img_x, img_y
 
     def paintEvent(self, event) -> None:
         """
@@ -124,60 +229,82 @@ class SegmentViewer(ScrollViewer):
         if not self.pages:
             return
 
-        p = QPainter(self)
-        p.setRenderHint(QPainter.RenderHint.Antialiasing)
-        p.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform)
+        self.ensure_page_rects()
+        zooming = self.is_zooming()
 
-        widget_height = self.height()
+        p = QPainter(self)
+        # 缩放过程中使用快速拉伸
+        p.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform, not zooming)
+
+        dirty_rect = event.rect()  # 需要重绘的区域
+
+        # page_y 递增，二分查找与重绘区域纵向重叠的页面范围，
+        # 只处理其中与重绘区域相交的页面（边框比页面多占 1 像素）
+        first_page = max(0, bisect.bisect_right(self.page_y, dirty_rect.top()) - 1)
+        last_page = bisect.bisect_right(self.page_y, dirty_rect.bottom())
+        visible_pages = []
+        for page_index in range(first_page, last_page):
+            px = self.page_x[page_index]
+            py = self.page_y[page_index]
+            pw = self.page_w[page_index]
+            ph = self.page_h[page_index]
+            if dirty_rect.intersects(QRect(px, py, pw + 1, ph + 1)):
+                visible_pages.append((px, py, pw, ph))
 
         # 绘制白色背景页面
-        for page_index, px, py, pw, ph in self.page_rects:
-            # 只绘制在可见范围内的页面
-            if py + ph > 0 and py < widget_height:
-                p.fillRect(px, py, pw, ph, QColor(255, 255, 255))
+        for px, py, pw, ph in visible_pages:
+            p.fillRect(px, py, pw, ph, QColor(255, 255, 255))
 
         # 绘制所有 segments
         for index, segment in enumerate(self.segments):
-            if index >= len(self.scaled_segments):
-                break
-
-            page_index = segment.target_rect.page_index
-            # 找到对应的页面位置信息
-            for pi, px, py, pw, ph in self.page_rects:
-                if pi == page_index:
-                    # 计算图像在页面中的位置
-                    img_x = px + int(segment.target_rect.x_min * pw)
-                    img_y = py + int(segment.target_rect.y_min * ph)
-
-                    # 使用缓存的缩放图像
-                    scaled_pixmap = self.scaled_segments[index]
-                    p.drawPixmap(img_x, img_y, scaled_pixmap)
-                    break
+            # 计算图像在页面中的位置
+            img_x, img_y = self.get_segment_position(segment)
+
+            # 只绘制（并缩放）与重绘区域相交的图像
+            target_rect = QRect(QPoint(img_x, img_y), self.get_scaled_segment_size(index))
+            if not dirty_rect.intersects(target_rect):
+                continue
+
+            # 与 ImagePagesViewer 相同的顺序：当前缩放因子下的图像、缩放前的图像、原图像
+            # 缩放过程中不进行缩放，停止缩放后再生成高质量图像
+            pixmap = self.get_scaled_segment(index, scale=not zooming)
+            if pixmap is None:
+                pixmap = self.scaled_segments.get((id(segment), round(self.settled_zoom, 3)))
+            if pixmap is None:
+                pixmap = self.get_clipped_pixmap(segment)
+
+            # 不透明的图像直接覆盖目标像素，省去 alpha 混合
+            p.setCompositionMode(
+                QPainter.CompositionMode.CompositionMode_SourceOver
+                if pixmap.hasAlphaChannel()
+                else QPainter.CompositionMode.CompositionMode_Source
+            )
+            p.drawPixmap(target_rect, pixmap)
+
+        # 之后的边框绘制使用默认的合成模式，并开启抗锯齿
+        p.setCompositionMode(QPainter.CompositionMode.CompositionMode_SourceOver)
+        p.setRenderHint(QPainter.RenderHint.Antialiasing)
 
         # 给当前鼠标悬浮的 segment 绘制边框
         if self.hovered_segment_index is not None:
             segment = self.segments[self.hovered_segment_index]
-            page_index = segment.target_rect.page_index
-
-            for pi, px, py, pw, ph in self.page_rects:
-                if pi == page_index:
-                    img_x = px + int(segment.target_rect.x_min * pw)
-                    img_y = py + int(segment.target_rect.y_min * ph)
+            img_x, img_y = self.get_segment_position(segment)
 
-                    if self.dragging_segment:
-                        offset = self.get_segment_dragging_offset()
-                        img_x += offset.x()
-                        img_y += offset.y()
+            if self.dragging_segment:
+                offset = self.get_segment_dragging_offset()
+                img_x += offset.x()
+                img_y += offset.y()
 
-                    scaled_pixmap = self.scaled_segments[self.hovered_segment_index]
-                    # 绘制蓝色边框
-                    p.setPen(QColor(50, 150, 255))
-                    p.drawRect(img_x, img_y, scaled_pixmap.width(), scaled_pixmap.height())
-                    break
+            scaled_size = self.get_scaled_segment_size(self.hovered_segment_index)
+            border_rect = QRect(QPoint(img_x, img_y), scaled_size)
+            # 绘制蓝色边框
+            if dirty_rect.intersects(border_rect.adjusted(0, 0, 1, 1)):
+                p.setPen(QColor(50, 150, 255))
+                p.drawRect(border_rect)
 
         # 最后绘制所有页面边框，避免被图像覆盖
         p.setPen(QColor(200, 200, 200))
-        for _, px, py, pw, ph in self.page_rects:
+        for px, py, pw, ph in visible_pages:
             p.drawRect(px, py, pw, ph)
 
     def get_hovered_segment(self, mouse_pos) -> int | None:
@@ -185,27 +312,22 @@ class SegmentViewer(ScrollViewer):
         if not self.pages or not self.segments:
             return None
 
-        # 从后往前查找（后添加的在上层）
-        for segment_index in range(len(self.segments) - 1, -1, -1):
-            if segment_index >= len(self.scaled_segments):
-                continue
+        self.ensure_page_rects()
 
-            segment = self.segments[segment_index]
-            page_index = segment.target_rect.page_index
+        # 二分查找鼠标所在的页面（页面按 y 坐标排列），只检查该页面上的 segments
+        page_index = bisect.bisect_right(self.page_y, mouse_pos.y()) - 1
+        if page_index < 0:
+            return None
 
-            for pi, px, py, pw, ph in self.page_rects:
-                if pi == page_index:
-                    img_x = px + int(segment.target_rect.x_min * pw)
-                    img_y = py + int(segment.target_rect.y_min * ph)
-                    scaled_pixmap = self.scaled_segments[segment_index]
-                    img_width = scaled_pixmap.width()
-                    img_height = scaled_pixmap.height()
+        # 从后往前查找（后添加的在上层）
+        for segment_index in reversed(self.segments_by_page.get(page_index, [])):
+            img_x, img_y = self.get_segment_position(self.segments[segment_index])
+            img_width, img_height = self.get_scaled_segment_size(segment_index).toTuple()
 
-                    # 检查鼠标是否在这个 segment 区域内
-                    if (img_x <= mouse_pos.x() <= img_x + img_width and
-                            img_y <= mouse_pos.y() <= img_y + img_height):
-                        return segment_index
-                    break
+            # 检查鼠标是否在这个 segment 区域内
+            if (img_x <= mouse_pos.x() <= img_x + img_width and
+                    img_y <= mouse_pos.y() <= img_y + img_height):
+                return segment_index
 
         return None
 
@@ -250,13 +372,21 @@ class SegmentViewer(ScrollViewer):
             target = segment.target_rect
 
             if target.page_index != current_page_index:
+                # 更新页面索引，保持每个页面中的 segment 按添加顺序排列
+                self.segments_by_page[target.page_index].remove(self.hovered_segment_index)
+                bisect.insort(
+                    self.segments_by_page.setdefault(current_page_index, []),
+                    self.hovered_segment_index
+                )
+
                 target.page_index = current_page_index
                 x_offset = 0.5 - (target.x_min + target.x_max) / 2
                 y_offset = 0.5 - (target.y_min + target.y_max) / 2
 
             else:
-                scaled = self.scaled_segments[self.hovered_segment_index]
-                scaled_factor = scaled.width() / segment.clipped_pixmap.width()
+                # 只需要缩放后的宽度，不必解码并缩放图像
+                scaled_width = self.get_scaled_segment_size(self.hovered_segment_index).width()
+                scaled_factor = scaled_width / segment.clipped_size.width()
 
                 page_size = self.pages[segment.selected_rect.page_index]
                 scaled_page_size = page_size * scaled_factor
@@ -284,7 +414,14 @@ class SegmentViewer(ScrollViewer):
         return offset
 
     def get_current_page_index(self, pos: QPoint) -> int | None:
-        for pi, px, py, pw, ph in self.page_rects:
-            if 0 <= pos.x() - px <= pw and 0 <= pos.y() - py <= ph:
-                return pi
+        self.ensure_page_rects()
+
+        # 二分查找 pos 所在的页面，再检查是否确实位于页面范围内
+        page_index = bisect.bisect_right(self.page_y, pos.y()) - 1
+        if page_index < 0:
+            return None
+
+        px, py = self.page_x[page_index], self.page_y[page_index]
+        if 0 <= pos.x() - px <= self.page_w[page_index] and 0 <= pos.y() - py <= self.page_h[page_index]:
+            return page_index
         return None
@@ -26,7 +26,12 @@ def main() -> None:
     doc1 = pdf.open(file1)
     doc2 = pdf.open(file2)
     doc1.insert_pdf(doc2)
-    doc1.save(output_file)
+    # 清理未引用的对象并压缩；直接传入路径，由 MuPDF 自行缓冲写入，
+    # 且输出文件与 file1 相同时 MuPDF 会在写入前报错，不会清空原文件
+    doc1.save(output_file, garbage=4, deflate=True, clean=True)
+    # doc2 需要在保存之后再关闭
+    doc2.close()
+    doc1.close()
 
 
 if __name__ == '__main__':